@@ -4,6 +4,8 @@ from .api import fetch_device
 from .device import Device
 from .errors import *
 from .firmware import Firmware, FirmwareImage
+from .fleet import DeviceFleet
+from .jobs import JobStatus, ShardStats, SigningJob, SigningQueue
 from .manifest import BuildIdentity, BuildManifest, RestoreType
 from .soc import *
 from .tss import TSS
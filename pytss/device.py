@@ -10,6 +10,37 @@ RELEASE_API = 'https://api.ipsw.me/v4/device'
 BETA_API = 'https://api.m1sta.xyz/betas'
 
 
+def _ap_nonce_length(chip_id: int) -> int:
+    return 32 if 0x8010 <= chip_id < 0x8900 else 20
+
+
+def _is_64bit(chip_id: int) -> bool:
+    return not 0x8900 < chip_id < 0x8955
+
+
+def _parse_ecid(ecid: Optional[Union[int, str]]) -> Optional[int]:
+    if isinstance(ecid, str):  # Assume hexadecimal
+        try:
+            ecid = int(ecid, 16)
+        except ValueError:
+            raise ValueError('Invalid ECID provided')
+
+    return ecid
+
+
+def _parse_nonce(nonce: Union[bytes, str], length: int, name: str) -> bytes:
+    if isinstance(nonce, str):  # Assume hexadecimal
+        try:
+            nonce = bytes.fromhex(nonce)
+        except ValueError:
+            raise ValueError(f'Invalid {name} nonce provided')
+
+    if len(nonce) != length:
+        raise ValueError(f'Invalid {name} nonce provided')
+
+    return nonce
+
+
 class Device:
     def __init__(
         self,
@@ -26,7 +57,7 @@ class Device:
         self.ecid = ecid
         self.ap_nonce = None
 
-        self.sep_nonce = None
+        self._sep_nonce = None  # Generated on first access
 
     @property
     def ap_nonce(self) -> bytes:
@@ -34,17 +65,8 @@ class Device:
 
     @ap_nonce.setter
     def ap_nonce(self, ap_nonce: Optional[Union[bytes, str]]) -> None:
-        ap_nonce_len = 32 if 0x8010 <= self.chip_id < 0x8900 else 20
-
         if ap_nonce is not None:
-            if isinstance(ap_nonce, str):  # Assume hexadecimal
-                try:
-                    ap_nonce = bytes.fromhex(ap_nonce)
-                except TypeError:
-                    raise ValueError('Invalid AP nonce provided')
-
-            if len(ap_nonce) != ap_nonce_len:
-                raise ValueError('Invalid AP nonce provided')
+            ap_nonce = _parse_nonce(ap_nonce, _ap_nonce_length(self.chip_id), 'AP')
         else:
             ap_nonce = bytes()  # Set as empty bytes
 
@@ -56,16 +78,13 @@ class Device:
 
     @ecid.setter
     def ecid(self, ecid: Optional[Union[int, str]]) -> None:
-        if isinstance(ecid, str):  # Assume hexadecimal
-            try:
-                ecid = int(ecid, 16)
-            except ValueError:
-                raise ValueError('Invalid ECID provided')
-
-        self._ecid = ecid
+        self._ecid = _parse_ecid(ecid)
 
     @property
-    def sep_nonce(self) -> bytes:
+    def sep_nonce(self) -> Optional[bytes]:
+        if self._sep_nonce is None and self.is_64bit:
+            self._sep_nonce = getrandbits(160).to_bytes(20, 'big')
+
         return self._sep_nonce
 
     @sep_nonce.setter
@@ -74,22 +93,13 @@ class Device:
             raise TypeError('32-bit devices do not have SEP')
 
         if sep_nonce is not None:
-            if isinstance(sep_nonce, str):
-                try:
-                    sep_nonce = bytes.fromhex(sep_nonce)
-                except TypeError:
-                    raise ValueError('Invalid SEP nonce provided')
-
-            if len(sep_nonce) != 20:
-                raise ValueError('Invalid SEP nonce provided')
-        else:
-            sep_nonce = bytes(getrandbits(8) for _ in range(20))
+            sep_nonce = _parse_nonce(sep_nonce, 20, 'SEP')
 
-        self._sep_nonce = sep_nonce
+        self._sep_nonce = sep_nonce  # A random nonce is generated if unset
 
     @property
     def is_64bit(self) -> bool:
-        return not 0x8900 < self.chip_id < 0x8955
+        return _is_64bit(self.chip_id)
 
     @property
     def supports_img4(self) -> bool:
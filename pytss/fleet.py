@@ -0,0 +1,376 @@
+import csv
+from array import array
+from itertools import repeat
+from random import getrandbits
+from typing import (
+    IO,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import ujson
+
+from .device import Device, _ap_nonce_length, _is_64bit, _parse_ecid, _parse_nonce
+from .firmware import Firmware
+from .manifest import BuildIdentity, BuildManifest, RestoreType
+from .tss import TSS
+
+FLEET_COLUMNS = ('identifier', 'chip_id', 'board_id', 'ecid', 'ap_nonce', 'sep_nonce')
+
+AP_NONCE_STRIDE = 32
+SEP_NONCE_STRIDE = 20
+
+
+def _int_column(values: Iterable, typecode: str, name: str, base: int) -> array:
+    values = list(values)
+
+    # Fast paths: all ints, then all strings
+    try:
+        return array(typecode, values)
+    except TypeError:
+        pass
+    except OverflowError:
+        raise ValueError(f'Invalid {name} provided')
+
+    try:
+        return array(typecode, map(int, values, repeat(base)))
+    except (TypeError, ValueError, OverflowError):
+        pass
+
+    # Mixed ints and strings, or an invalid row
+    column = array(typecode)
+    for i, value in enumerate(values):
+        try:
+            column.append(int(value, base) if isinstance(value, str) else value)
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError(f"Invalid {name} provided in row {i}: '{value}'")
+
+    return column
+
+
+def _nonce_column(
+    values: List[Optional[Union[bytes, str]]],
+    lengths: Iterable[int],
+    stride: int,
+    name: str,
+) -> Tuple[bytearray, array]:
+    lengths = list(lengths)
+
+    # Fast path: every nonce is hexadecimal (or empty), decoded in a single call
+    if all(map(isinstance, values, repeat(str))):
+        hex_lens = list(map(len, values))
+        if all(n == 0 or n == 2 * l for n, l in zip(hex_lens, lengths)):
+            try:
+                buf = bytearray(
+                    bytes.fromhex(
+                        ''.join(map(str.ljust, values, repeat(2 * stride), repeat('0')))
+                    )
+                )
+            except ValueError:
+                pass
+            else:
+                # fromhex() skips whitespace, which would shift every later nonce
+                if len(buf) == stride * len(values):
+                    return buf, array('B', (n // 2 for n in hex_lens))
+
+    buf = bytearray(stride * len(values))
+    nonce_lens = array('B', bytes(len(values)))
+    for i, (nonce, length) in enumerate(zip(values, lengths)):
+        if nonce is None or nonce in ('', b''):
+            continue
+
+        try:
+            nonce = _parse_nonce(nonce, length, name)
+        except ValueError:
+            raise ValueError(f'Invalid {name} nonce provided in row {i}')
+
+        buf[i * stride : i * stride + length] = nonce
+        nonce_lens[i] = length
+
+    return buf, nonce_lens
+
+
+class _FleetDevice(Device):
+    def __init__(self, fleet: 'DeviceFleet', index: int):
+        self._fleet = fleet
+        self._index = index
+
+    @property
+    def identifier(self) -> str:
+        fleet = self._fleet
+        return fleet._identifier_table[fleet._identifier_codes[self._index]]
+
+    @property
+    def chip_id(self) -> int:
+        return self._fleet._chip_ids[self._index]
+
+    @property
+    def board_id(self) -> int:
+        return self._fleet._board_ids[self._index]
+
+    @property
+    def ecid(self) -> int:
+        return self._fleet._ecids[self._index]
+
+    @ecid.setter
+    def ecid(self, ecid: Union[int, str]) -> None:
+        fleet = self._fleet
+        ecid = _parse_ecid(ecid)
+        if ecid is None:
+            raise ValueError('Invalid ECID provided')
+
+        old_ecid = fleet._ecids[self._index]
+        if ecid == old_ecid:
+            return
+
+        ecid_index = fleet._get_ecid_index()
+        if ecid in ecid_index:
+            raise ValueError(f"Duplicate ECID provided: '{hex(ecid)}'")
+
+        try:
+            fleet._ecids[self._index] = ecid
+        except OverflowError:
+            raise ValueError('Invalid ECID provided')
+
+        del ecid_index[old_ecid]
+        ecid_index[ecid] = self._index
+
+    @property
+    def ap_nonce(self) -> bytes:
+        fleet = self._fleet
+        offset = self._index * AP_NONCE_STRIDE
+        return bytes(
+            fleet._ap_nonces[offset : offset + fleet._ap_nonce_lens[self._index]]
+        )
+
+    @ap_nonce.setter
+    def ap_nonce(self, ap_nonce: Optional[Union[bytes, str]]) -> None:
+        fleet = self._fleet
+        offset = self._index * AP_NONCE_STRIDE
+        if ap_nonce is not None:
+            ap_nonce = _parse_nonce(ap_nonce, _ap_nonce_length(self.chip_id), 'AP')
+        else:
+            ap_nonce = bytes()  # Set as empty bytes
+
+        fleet._ap_nonces[offset : offset + len(ap_nonce)] = ap_nonce
+        fleet._ap_nonce_lens[self._index] = len(ap_nonce)
+
+    @property
+    def sep_nonce(self) -> Optional[bytes]:
+        if not self.is_64bit:
+            return None
+
+        fleet = self._fleet
+        offset = self._index * SEP_NONCE_STRIDE
+        if not fleet._sep_nonce_lens[self._index]:
+            fleet._sep_nonces[offset : offset + SEP_NONCE_STRIDE] = getrandbits(
+                160
+            ).to_bytes(SEP_NONCE_STRIDE, 'big')
+            fleet._sep_nonce_lens[self._index] = SEP_NONCE_STRIDE
+
+        return bytes(fleet._sep_nonces[offset : offset + SEP_NONCE_STRIDE])
+
+    @sep_nonce.setter
+    def sep_nonce(self, sep_nonce: Optional[Union[bytes, str]]) -> None:
+        if not self.is_64bit:
+            raise TypeError('32-bit devices do not have SEP')
+
+        fleet = self._fleet
+        if sep_nonce is not None:
+            sep_nonce = _parse_nonce(sep_nonce, SEP_NONCE_STRIDE, 'SEP')
+            offset = self._index * SEP_NONCE_STRIDE
+            fleet._sep_nonces[offset : offset + SEP_NONCE_STRIDE] = sep_nonce
+            fleet._sep_nonce_lens[self._index] = SEP_NONCE_STRIDE
+        else:
+            fleet._sep_nonce_lens[self._index] = 0  # A random nonce is generated
+
+
+class DeviceFleet:
+    def __init__(
+        self,
+        identifiers: Iterable[str],
+        chip_ids: Iterable[Union[int, str]],
+        board_ids: Iterable[Union[int, str]],
+        ecids: Iterable[Union[int, str]],
+        *,
+        ap_nonces: Optional[Iterable[Optional[Union[bytes, str]]]] = None,
+        sep_nonces: Optional[Iterable[Optional[Union[bytes, str]]]] = None,
+    ):
+        # Fleets only contain a handful of distinct identifiers
+        identifier_map: Dict[str, int] = {}
+        self._identifier_codes = array(
+            'H',
+            (identifier_map.setdefault(i, len(identifier_map)) for i in identifiers),
+        )
+        self._identifier_table = list(identifier_map)
+
+        # Chip/board IDs are decimal unless prefixed with '0x' (as on IPSW.me), ECIDs
+        # are always hexadecimal (as with Device)
+        self._chip_ids = _int_column(chip_ids, 'I', 'chip ID', 0)
+        self._board_ids = _int_column(board_ids, 'I', 'board ID', 0)
+        self._ecids = _int_column(ecids, 'Q', 'ECID', 16)
+
+        count = len(self._identifier_codes)
+        if not len(self._chip_ids) == len(self._board_ids) == len(self._ecids) == count:
+            raise ValueError('All device columns must be the same length')
+
+        if len(set(self._ecids)) != count:
+            seen = set()
+            for i, ecid in enumerate(self._ecids):
+                if ecid in seen:
+                    raise ValueError(
+                        f"Duplicate ECID provided in row {i}: '{hex(ecid)}'"
+                    )
+
+                seen.add(ecid)
+
+        ap_nonces = list(ap_nonces) if ap_nonces is not None else [None] * count
+        if len(ap_nonces) != count:
+            raise ValueError('All device columns must be the same length')
+
+        self._ap_nonces, self._ap_nonce_lens = _nonce_column(
+            ap_nonces, map(_ap_nonce_length, self._chip_ids), AP_NONCE_STRIDE, 'AP'
+        )
+
+        sep_nonces = list(sep_nonces) if sep_nonces is not None else [None] * count
+        if len(sep_nonces) != count:
+            raise ValueError('All device columns must be the same length')
+
+        self._sep_nonces, self._sep_nonce_lens = _nonce_column(
+            sep_nonces, repeat(SEP_NONCE_STRIDE, count), SEP_NONCE_STRIDE, 'SEP'
+        )
+
+        for i, (chip_id, set_) in enumerate(zip(self._chip_ids, self._sep_nonce_lens)):
+            if set_ and not _is_64bit(chip_id):
+                raise TypeError(f'32-bit devices do not have SEP (row {i})')
+
+        self._ecid_index: Optional[Dict[int, int]] = None
+
+    @classmethod
+    def from_devices(cls, devices: Iterable[Device]) -> 'DeviceFleet':
+        devices = list(devices)
+        if any(d.ecid is None for d in devices):
+            raise TypeError('No ECID is set')
+
+        return cls(
+            (d.identifier for d in devices),
+            (d.chip_id for d in devices),
+            (d.board_id for d in devices),
+            (d.ecid for d in devices),
+            ap_nonces=(d.ap_nonce for d in devices),
+            sep_nonces=(d.sep_nonce for d in devices),
+        )
+
+    @classmethod
+    def _from_rows(cls, columns: List[str], rows: List[list]) -> 'DeviceFleet':
+        for column in FLEET_COLUMNS[:4]:
+            if column not in columns:
+                raise KeyError(f"Required column not found in device fleet: '{column}'")
+
+        for i, row in enumerate(rows):
+            if len(row) != len(columns):
+                raise ValueError(
+                    f'Expected {len(columns)} fields in row {i}, found {len(row)}'
+                )
+
+        data = dict(zip(columns, zip(*rows))) if rows else dict.fromkeys(columns, ())
+        return cls(
+            data['identifier'],
+            data['chip_id'],
+            data['board_id'],
+            data['ecid'],
+            ap_nonces=data.get('ap_nonce'),
+            sep_nonces=data.get('sep_nonce'),
+        )
+
+    @classmethod
+    def from_csv(cls, file: Union[str, IO[str]]) -> 'DeviceFleet':
+        if isinstance(file, str):
+            with open(file, newline='') as f:
+                return cls.from_csv(f)
+
+        reader = csv.reader(file)
+        header = next(reader, None)
+        if header is None:  # Empty file
+            return cls((), (), (), ())
+
+        columns = [c.strip().lower() for c in header]
+        return cls._from_rows(columns, [row for row in reader if row])
+
+    @classmethod
+    def from_jsonl(cls, file: Union[str, IO[str]]) -> 'DeviceFleet':
+        if isinstance(file, str):
+            with open(file) as f:
+                return cls.from_jsonl(f)
+
+        # ujson decodes the whole fleet as a single array in one call
+        lines = [line for line in map(str.strip, file) if line]
+        entries = ujson.loads(f"[{','.join(lines)}]")
+        if not entries:  # Empty file
+            return cls((), (), (), ())
+
+        columns = [c for c in FLEET_COLUMNS if any(c in e for e in entries)]
+        return cls._from_rows(columns, [[e.get(c) for c in columns] for e in entries])
+
+    def __len__(self) -> int:
+        return len(self._ecids)
+
+    def __getitem__(self, index: int) -> Device:
+        if index < 0:
+            index += len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError('Device fleet index out of range')
+
+        return _FleetDevice(self, index)
+
+    def __iter__(self) -> Iterator[Device]:
+        return map(_FleetDevice, repeat(self), range(len(self)))
+
+    @property
+    def ecids(self) -> array:
+        return self._ecids
+
+    def _get_ecid_index(self) -> Dict[int, int]:
+        if self._ecid_index is None:
+            self._ecid_index = {e: i for i, e in enumerate(self._ecids)}
+
+        return self._ecid_index
+
+    def get_device(self, ecid: Union[int, str]) -> Device:
+        index = self._get_ecid_index().get(_parse_ecid(ecid))
+        if index is None:
+            raise ValueError(f"Device not found in fleet: '{ecid}'")
+
+        return _FleetDevice(self, index)
+
+    async def new_tss(
+        self,
+        *,
+        firmware: Firmware = None,
+        build_manifest: BuildManifest = None,
+        restore_type: RestoreType,
+    ) -> AsyncIterator[TSS]:
+        if build_manifest is None:
+            if firmware is None:
+                raise TypeError('Neither a firmware nor a build manifest were provided')
+
+            build_manifest = BuildManifest(await firmware.read('BuildManifest.plist'))
+
+        # Devices sharing a board share a build identity
+        identities: Dict[Tuple[int, int], BuildIdentity] = {}
+        for device in self:
+            key = (device.chip_id, device.board_id)
+            identity = identities.get(key)
+            if identity is None:
+                identity = identities[key] = build_manifest.get_identity(
+                    device, restore_type
+                )
+
+            yield TSS(device, identity)
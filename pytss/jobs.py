@@ -0,0 +1,483 @@
+import asyncio
+import logging
+import plistlib
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from enum import Enum
+from functools import partial
+from random import getrandbits
+from typing import Dict, Generator, Iterable, Iterator, List, Optional, Tuple, Union
+
+from .device import Device
+from .fleet import DeviceFleet
+from .manifest import BuildIdentity, BuildManifest, RestoreType
+from .tss import TSS
+
+logger = logging.getLogger(__name__)
+
+# The database uses the default rollback journal, as WAL requires all workers to
+# be on the same host. Sharing it between hosts is only safe on filesystems with
+# working POSIX locks (e.g. a single local disk, or Lustre/GPFS with locking
+# enabled). NFS and SMB locking is unreliable and can let two workers lease the
+# same job. Lease expiry is also based on each host's time.time(), so hosts must
+# have synchronized clocks, or a host whose clock runs fast will re-lease (and
+# re-sign) jobs that are still being worked on.
+JOBS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    ecid INTEGER NOT NULL,
+    buildid TEXT NOT NULL,
+    restore_type TEXT NOT NULL,
+    shard INTEGER NOT NULL,
+    identifier TEXT NOT NULL,
+    chip_id INTEGER NOT NULL,
+    board_id INTEGER NOT NULL,
+    ap_nonce BLOB NOT NULL,
+    sep_nonce BLOB,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease INTEGER,
+    lease_expires REAL,
+    started REAL,
+    finished REAL,
+    error TEXT,
+    response BLOB,
+    PRIMARY KEY (ecid, buildid, restore_type)
+);
+CREATE INDEX IF NOT EXISTS jobs_status_shard_ecid ON jobs (status, shard, ecid);
+CREATE INDEX IF NOT EXISTS jobs_status_lease_expires ON jobs (status, lease_expires);
+CREATE INDEX IF NOT EXISTS jobs_lease ON jobs (lease);
+CREATE TABLE IF NOT EXISTS queue_info (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+'''
+
+
+class JobStatus(str, Enum):
+    PENDING = 'pending'
+    LEASED = 'leased'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class SigningJob:
+    def __init__(
+        self,
+        device: Device,
+        buildid: str,
+        restore_type: RestoreType,
+        *,
+        shard: int,
+        lease: int,
+        attempts: int,
+    ):
+        self.device = device
+        self.buildid = buildid
+        self.restore_type = restore_type
+        self.shard = shard
+        self.lease = lease
+        self.attempts = attempts
+
+    @property
+    def key(self) -> Tuple[int, str, str]:
+        return (self.device.ecid, self.buildid, self.restore_type.value)
+
+
+class ShardStats:
+    def __init__(
+        self,
+        shard: int,
+        counts: Dict[JobStatus, int],
+        started: Optional[float],
+        finished: Optional[float],
+    ):
+        self.shard = shard
+        self.pending = counts.get(JobStatus.PENDING, 0)
+        self.leased = counts.get(JobStatus.LEASED, 0)
+        self.done = counts.get(JobStatus.DONE, 0)
+        self.failed = counts.get(JobStatus.FAILED, 0)
+
+        self._started = started
+        self._finished = finished
+
+    @property
+    def throughput(self) -> float:
+        if self._started is None or self._finished is None:
+            return 0.0
+
+        elapsed = self._finished - self._started
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+
+class SigningQueue:
+    def __init__(
+        self,
+        path: str,
+        *,
+        shards: int = 16,
+        lease_duration: float = 60.0,
+        max_attempts: int = 3,
+    ):
+        self.lease_duration = lease_duration
+        self.max_attempts = max_attempts
+
+        self._path = path
+        # Autocommit mode, transactions are opened explicitly
+        self._db = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        # The connection is shared between the caller's thread and run()'s
+        # executor, which keeps database calls off the event loop
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._db.executescript(JOBS_SCHEMA)
+
+        # The shard count is fixed by whoever creates the queue
+        with self._transaction():
+            self._db.execute(
+                "INSERT OR IGNORE INTO queue_info VALUES ('shards', ?)", (shards,)
+            )
+            (self.shards,) = self._db.execute(
+                "SELECT value FROM queue_info WHERE key = 'shards'"
+            ).fetchone()
+
+    @contextmanager
+    def _transaction(self) -> Generator[None, None, None]:
+        with self._lock:
+            # Take the write lock up front so concurrent leases can't overlap
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            else:
+                self._db.execute('COMMIT')
+
+    def close(self) -> None:
+        self._executor.shutdown()
+        self._db.close()
+
+    async def _call(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, partial(func, *args, **kwargs)
+        )
+
+    def add(
+        self,
+        devices: Union[Device, Iterable[Device], DeviceFleet],
+        buildid: str,
+        restore_type: RestoreType,
+    ) -> int:
+        if isinstance(devices, Device):
+            devices = (devices,)
+
+        rows = []
+        for device in devices:
+            if device.ecid is None:
+                raise TypeError('No ECID is set')
+
+            # SQLite integers are signed 64-bit
+            if not 0 <= device.ecid < 1 << 63:
+                raise ValueError(f"Invalid ECID provided: '{hex(device.ecid)}'")
+
+            rows.append(
+                (
+                    device.ecid,
+                    buildid,
+                    restore_type.value,
+                    device.ecid % self.shards,
+                    device.identifier,
+                    device.chip_id,
+                    device.board_id,
+                    device.ap_nonce,
+                    device.sep_nonce,  # Stored so retries reuse the same nonce
+                )
+            )
+
+        with self._transaction():
+            before = self._db.total_changes
+            self._db.executemany(
+                'INSERT OR IGNORE INTO jobs (ecid, buildid, restore_type, shard, '
+                'identifier, chip_id, board_id, ap_nonce, sep_nonce) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                rows,
+            )
+            return self._db.total_changes - before
+
+    def lease(
+        self, worker: str, *, shards: Iterable[int] = None, limit: int = 64
+    ) -> List[SigningJob]:
+        shards = list(range(self.shards) if shards is None else shards)
+        now = time.time()
+        lease = getrandbits(63)
+
+        with self._transaction():
+            # Leases held by crashed workers that have run out of attempts
+            self._db.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Lease expired', "
+                'worker = NULL, lease = NULL, lease_expires = NULL '
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+
+            # Expired leases first, then pending jobs, one shard at a time so each
+            # query walks an index and stops at the limit instead of sorting
+            keys = []
+            for shard in shards:
+                for query, params in (
+                    (
+                        "WHERE status = 'leased' AND lease_expires < ? AND shard = ?",
+                        (now, shard),
+                    ),
+                    ("WHERE status = 'pending' AND shard = ? ORDER BY ecid", (shard,)),
+                ):
+                    if len(keys) >= limit:
+                        break
+
+                    keys.extend(
+                        self._db.execute(
+                            f'SELECT ecid, buildid, restore_type FROM jobs {query} '
+                            'LIMIT ?',
+                            (*params, limit - len(keys)),
+                        )
+                    )
+
+            self._db.executemany(
+                "UPDATE jobs SET status = 'leased', worker = ?, lease = ?, "
+                'lease_expires = ?, attempts = attempts + 1, '
+                'started = COALESCE(started, ?) '
+                'WHERE ecid = ? AND buildid = ? AND restore_type = ?',
+                ((worker, lease, now + self.lease_duration, now, *key) for key in keys),
+            )
+
+            rows = self._db.execute(
+                'SELECT ecid, buildid, restore_type, shard, identifier, chip_id, '
+                'board_id, ap_nonce, sep_nonce, attempts FROM jobs WHERE lease = ?',
+                (lease,),
+            ).fetchall()
+
+        jobs = []
+        for (
+            ecid,
+            buildid,
+            restore_type,
+            shard,
+            identifier,
+            chip_id,
+            board_id,
+            ap_nonce,
+            sep_nonce,
+            attempts,
+        ) in rows:
+            device = Device(identifier, chip_id, board_id, ecid=ecid)
+            device.ap_nonce = ap_nonce or None
+            if sep_nonce is not None:
+                device.sep_nonce = sep_nonce
+
+            jobs.append(
+                SigningJob(
+                    device,
+                    buildid,
+                    RestoreType(restore_type),
+                    shard=shard,
+                    lease=lease,
+                    attempts=attempts,
+                )
+            )
+
+        return jobs
+
+    def heartbeat(self, jobs: Iterable[SigningJob]) -> None:
+        lease_expires = time.time() + self.lease_duration
+        with self._transaction():
+            self._db.executemany(
+                'UPDATE jobs SET lease_expires = ? '
+                "WHERE lease = ? AND status = 'leased' AND ecid = ? "
+                'AND buildid = ? AND restore_type = ?',
+                ((lease_expires, job.lease, *job.key) for job in jobs),
+            )
+
+    def complete(self, job: SigningJob, response: dict) -> bool:
+        # False if the lease was lost to another worker
+        return self.finish([(job, response, None)])[0]
+
+    def fail(self, job: SigningJob, error: str) -> bool:
+        return self.finish([(job, None, error)])[0]
+
+    def finish(
+        self, results: Iterable[Tuple[SigningJob, Optional[dict], Optional[str]]]
+    ) -> List[bool]:
+        finished = []
+        now = time.time()
+        with self._transaction():
+            for job, response, error in results:
+                if error is None:
+                    cursor = self._db.execute(
+                        "UPDATE jobs SET status = 'done', finished = ?, response = ?, "
+                        'error = NULL, worker = NULL, lease = NULL, '
+                        'lease_expires = NULL '
+                        "WHERE lease = ? AND status = 'leased' AND ecid = ? "
+                        'AND buildid = ? AND restore_type = ?',
+                        (now, plistlib.dumps(response), job.lease, *job.key),
+                    )
+                else:
+                    status = (
+                        JobStatus.FAILED
+                        if job.attempts >= self.max_attempts
+                        else JobStatus.PENDING
+                    )
+                    cursor = self._db.execute(
+                        'UPDATE jobs SET status = ?, error = ?, '
+                        'worker = NULL, lease = NULL, lease_expires = NULL '
+                        "WHERE lease = ? AND status = 'leased' AND ecid = ? "
+                        'AND buildid = ? AND restore_type = ?',
+                        (status.value, error, job.lease, *job.key),
+                    )
+
+                finished.append(cursor.rowcount == 1)
+
+        return finished
+
+    def _next_lease_expiry(self, shards: List[int]) -> Optional[float]:
+        shard_params = ', '.join('?' * len(shards))
+        with self._lock:
+            (pending,) = self._db.execute(
+                'SELECT EXISTS (SELECT 1 FROM jobs '
+                f"WHERE status = 'pending' AND shard IN ({shard_params}))",
+                shards,
+            ).fetchone()
+            if pending:
+                return time.time()
+
+            (lease_expires,) = self._db.execute(
+                'SELECT MIN(lease_expires) FROM jobs '
+                f"WHERE status = 'leased' AND shard IN ({shard_params})",
+                shards,
+            ).fetchone()
+
+        return lease_expires  # None once nothing is left to sign
+
+    def stats(self) -> Dict[int, ShardStats]:
+        counts: Dict[int, Dict[JobStatus, int]] = {s: {} for s in range(self.shards)}
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT shard, status, COUNT(*) FROM jobs GROUP BY shard, status'
+            ).fetchall()
+            times = {
+                shard: (started, finished)
+                for shard, started, finished in self._db.execute(
+                    'SELECT shard, MIN(started), MAX(finished) FROM jobs '
+                    "WHERE status = 'done' GROUP BY shard"
+                )
+            }
+
+        for shard, status, count in rows:
+            counts[shard][JobStatus(status)] = count
+
+        return {
+            shard: ShardStats(shard, counts[shard], *times.get(shard, (None, None)))
+            for shard in counts
+        }
+
+    def responses(
+        self, *, buildid: str = None, restore_type: RestoreType = None
+    ) -> Iterator[Tuple[int, str, RestoreType, dict]]:
+        query = (
+            'SELECT ecid, buildid, restore_type, response FROM jobs '
+            "WHERE status = 'done'"
+        )
+        params = []
+        if buildid is not None:
+            query += ' AND buildid = ?'
+            params.append(buildid)
+
+        if restore_type is not None:
+            query += ' AND restore_type = ?'
+            params.append(restore_type.value)
+
+        # A separate connection, so iterating doesn't hold up the queue
+        db = sqlite3.connect(self._path, timeout=30)
+        try:
+            for ecid, buildid_, restore_type_, response in db.execute(query, params):
+                response = plistlib.loads(response)
+                yield ecid, buildid_, RestoreType(restore_type_), response
+        finally:
+            db.close()
+
+    async def run(
+        self,
+        worker: str,
+        build_manifests: Dict[str, BuildManifest],
+        *,
+        shards: Iterable[int] = None,
+        concurrency: int = 16,
+    ) -> int:
+        shards = list(range(self.shards) if shards is None else shards)
+        identities: Dict[Tuple[str, RestoreType, int, int], BuildIdentity] = {}
+        signed = 0
+
+        while True:
+            jobs = await self._call(
+                self.lease, worker, shards=shards, limit=concurrency
+            )
+            if not jobs:
+                # Wait out leases held by other (possibly crashed) workers
+                lease_expires = await self._call(self._next_lease_expiry, shards)
+                if lease_expires is None:
+                    return signed
+
+                await asyncio.sleep(max(lease_expires - time.time(), 0) + 0.1)
+                continue
+
+            heartbeat = asyncio.create_task(self._heartbeat(jobs))
+            try:
+                results = await asyncio.gather(
+                    *(self._sign(job, build_manifests, identities) for job in jobs)
+                )
+            finally:
+                heartbeat.cancel()
+                with suppress(asyncio.CancelledError):
+                    await heartbeat
+
+            # One transaction per batch
+            finished = await self._call(self.finish, results)
+            signed += sum(
+                ok for ok, (_, _, error) in zip(finished, results) if error is None
+            )
+
+    async def _heartbeat(self, jobs: List[SigningJob]) -> None:
+        while True:
+            await asyncio.sleep(self.lease_duration / 3)
+            try:
+                await self._call(self.heartbeat, jobs)
+            except sqlite3.Error:
+                logger.exception('Failed to renew job leases, retrying')
+
+    async def _sign(
+        self,
+        job: SigningJob,
+        build_manifests: Dict[str, BuildManifest],
+        identities: Dict[Tuple[str, RestoreType, int, int], BuildIdentity],
+    ) -> Tuple[SigningJob, Optional[dict], Optional[str]]:
+        device = job.device
+        try:
+            key = (job.buildid, job.restore_type, device.chip_id, device.board_id)
+            identity = identities.get(key)
+            if identity is None:
+                build_manifest = build_manifests.get(job.buildid)
+                if build_manifest is None:
+                    raise KeyError(f"No build manifest provided for: '{job.buildid}'")
+
+                identity = identities[key] = build_manifest.get_identity(
+                    device, job.restore_type
+                )
+
+            response = await TSS(device, identity).send()
+            return job, response.data, None
+        except Exception as e:  # Recorded on the job, retried until max_attempts
+            return job, None, f'{e.__class__.__name__}: {e}'
@@ -157,6 +157,8 @@ class TSS:
             if any(i in name for i in ('BaseSystem', 'Diags')):
                 continue
 
+            img = dict(img)  # Don't modify the build identity itself
+
             # RestoreRequestRules are required for devices that use IMG4
             if self.device.supports_img4 == True:
                 if 'RestoreRequestRules' not in img['Info'].keys():
@@ -184,7 +186,7 @@ class TSS:
         }
         request.update(self.identity.baseband_data)
 
-        baseband_firmware = self.identity['Manifest']['BasebandFirmware']
+        baseband_firmware = dict(self.identity['Manifest']['BasebandFirmware'])
         baseband_firmware.pop('Info', None)  # Remove 'Info' dict if found
 
         if request['BbChipID'] == 0x68: